@@ -7,15 +7,23 @@ Production-ready WebSocket proxy server for Azure OpenAI Realtime API
 """
 
 import asyncio
+import heapq
 import websockets
 import json
 import os
 import logging
+import ssl
+import time
 import uuid
-from datetime import datetime, timedelta
-from typing import Dict, Set, Optional
+from typing import Dict, Optional
 from dotenv import load_dotenv
-from collections import defaultdict
+from websockets.protocol import State
+from collections import deque
+
+try:
+    import uvloop  # Faster event loop (not available on Windows)
+except ImportError:
+    uvloop = None
 
 # Load environment variables
 load_dotenv()
@@ -26,6 +34,10 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# Keep websockets' per-frame logging out of the hot path
+logging.getLogger('websockets').setLevel(logging.WARNING)
+# Checked once so the proxy loop doesn't even call logger.debug()
+DEBUG_ENABLED = logger.isEnabledFor(logging.DEBUG)
 
 # Azure OpenAI Configuration (server-side only, never exposed to client)
 AZURE_ENDPOINT = os.getenv('AZURE_ENDPOINT', '').rstrip('/')
@@ -38,9 +50,25 @@ SERVER_HOST = '0.0.0.0'
 SERVER_PORT = 8001
 
 # Session Management
+class UserState:
+    """Per-user bookkeeping: live session count and recent request timestamps"""
+    __slots__ = ('conns', 'reqs')
+    
+    def __init__(self):
+        self.conns = 0
+        self.reqs = deque()  # monotonic timestamps within the rate limit window
+    
+    def is_idle(self, now: float) -> bool:
+        """True when no sessions are live and no requests count toward the limit"""
+        return self.conns <= 0 and (not self.reqs or now - self.reqs[-1] >= RATE_LIMIT_WINDOW)
+
+
 sessions: Dict[str, dict] = {}  # session_id -> {user_id, created_at, azure_ws, client_ws}
-user_connections: Dict[str, Set[str]] = defaultdict(set)  # user_id -> set of session_ids
-user_requests: Dict[str, list] = defaultdict(list)  # user_id -> list of timestamps
+user_state: Dict[str, UserState] = {}  # user_id -> UserState
+session_expiries: list[tuple[float, str]] = []  # min-heap of (expires_at, session_id)
+SESSION_MAX_AGE = 3600  # seconds
+CLEANUP_INTERVAL = 3600  # seconds between fallback sweeps
+MESSAGE_COUNT_FLUSH = 128  # publish message_count every N messages (power of two)
 
 # Rate Limiting Configuration
 MAX_CONNECTIONS_PER_USER = 3
@@ -77,17 +105,70 @@ def build_azure_websocket_url():
     return url
 
 
+# Every input to the URL is fixed once the environment is loaded
+AZURE_WS_URL = build_azure_websocket_url()
+# Shared TLS context so the CA bundle is loaded once, not on every connect
+AZURE_SSL_CONTEXT = ssl.create_default_context()
+AZURE_CONNECT_OPTIONS = {
+    'ssl': AZURE_SSL_CONTEXT,
+    'max_size': 10 * 1024 * 1024,  # 10MB max message size
+    'ping_interval': 20,
+    'ping_timeout': 20,
+    'user_agent_header': 'Realtime-Voice-Bot/1.0',
+}
+
+
+class UUIDPool:
+    """Hands out random UUIDs from one batched os.urandom() read"""
+    __slots__ = ('_buf', '_off')
+    BATCH = 1024  # UUIDs per os.urandom() call
+    
+    def __init__(self):
+        self._buf = b''
+        self._off = 0
+    
+    def next_uuid(self) -> uuid.UUID:
+        if self._off + 16 > len(self._buf):
+            self._buf = os.urandom(16 * self.BATCH)
+            self._off = 0
+        u = uuid.UUID(bytes=self._buf[self._off:self._off + 16], version=4)
+        self._off += 16
+        return u
+
+
+uuid_pool = UUIDPool()
+
+
+def expire_sessions(now: float, limit: Optional[int] = None):
+    """Clean up sessions older than SESSION_MAX_AGE, at most `limit` of them"""
+    expired = 0
+    while session_expiries and session_expiries[0][0] < now:
+        _, sid = heapq.heappop(session_expiries)
+        # Sessions that already ended leave their entry behind; skip those
+        if sid in sessions:
+            logger.warning(f"Cleaning up stale session {sid[:8]}")
+            cleanup_session(sid)
+            expired += 1
+            if limit is not None and expired >= limit:
+                break
+
+
 def create_session(user_id: str) -> str:
     """Create a new session for a user"""
-    session_id = str(uuid.uuid4())
+    session_id = str(uuid_pool.next_uuid())
+    now = time.monotonic()
+    # Amortize stale-session cleanup over incoming connections
+    expire_sessions(now, limit=1)
     sessions[session_id] = {
         'user_id': user_id,
-        'created_at': datetime.now(),
+        'created_at': now,
         'azure_ws': None,
         'client_ws': None,
         'message_count': 0
     }
-    user_connections[user_id].add(session_id)
+    state = user_state.get(user_id) or user_state.setdefault(user_id, UserState())
+    state.conns += 1
+    heapq.heappush(session_expiries, (now + SESSION_MAX_AGE, session_id))
     logger.info(f"✓ Created session {session_id} for user {user_id}")
     return session_id
 
@@ -97,29 +178,34 @@ def cleanup_session(session_id: str):
     if session_id in sessions:
         session = sessions[session_id]
         user_id = session['user_id']
-        user_connections[user_id].discard(session_id)
+        state = user_state.get(user_id)
+        if state is not None:
+            state.conns -= 1
+            if state.is_idle(time.monotonic()):
+                del user_state[user_id]
         del sessions[session_id]
         logger.info(f"✓ Cleaned up session {session_id}")
 
 
 def check_rate_limit(user_id: str) -> tuple[bool, str]:
     """Check if user is within rate limits"""
-    now = datetime.now()
+    now = time.monotonic()
+    
+    state = user_state.get(user_id) or user_state.setdefault(user_id, UserState())
     
     # Check connection limit
-    if len(user_connections[user_id]) >= MAX_CONNECTIONS_PER_USER:
+    if state.conns >= MAX_CONNECTIONS_PER_USER:
         return False, f"Maximum {MAX_CONNECTIONS_PER_USER} concurrent connections exceeded"
     
-    # Check request rate limit
-    user_requests[user_id] = [
-        ts for ts in user_requests[user_id]
-        if (now - ts).total_seconds() < RATE_LIMIT_WINDOW
-    ]
+    # Check request rate limit (drop timestamps that fell out of the window)
+    timestamps = state.reqs
+    while timestamps and now - timestamps[0] >= RATE_LIMIT_WINDOW:
+        timestamps.popleft()
     
-    if len(user_requests[user_id]) >= MAX_REQUESTS_PER_MINUTE:
+    if len(timestamps) >= MAX_REQUESTS_PER_MINUTE:
         return False, f"Rate limit exceeded: {MAX_REQUESTS_PER_MINUTE} requests per minute"
     
-    user_requests[user_id].append(now)
+    timestamps.append(now)
     return True, "OK"
 
 
@@ -145,47 +231,75 @@ def authenticate_user(websocket) -> Optional[str]:
         user_id = auth_header.replace('Bearer ', '').strip()
     else:
         # For development: create anonymous user
-        user_id = f"anonymous-{uuid.uuid4().hex[:8]}"
+        user_id = f"anonymous-{uuid_pool.next_uuid().hex[:8]}"
     
     logger.info(f"✓ Authenticated user: {user_id}")
     return user_id
 
 
-async def proxy_client_to_azure(client_ws, azure_ws, session_id: str):
-    """Forward messages from client browser to Azure"""
+async def proxy_session(client_ws, azure_ws, session_id: str):
+    """
+    Forward messages between client browser and Azure from a single task.
+    The directions are coupled: while a send to a slow browser waits to
+    drain, client audio isn't forwarded to Azure (see ARCHITECTURE.md).
+    """
+    short_id = session_id[:8]
+    session = sessions[session_id]
+    message_count = session['message_count']
+    client_recv = asyncio.create_task(client_ws.recv())
+    azure_recv = asyncio.create_task(azure_ws.recv())
     try:
-        async for message in client_ws:
-            if isinstance(message, str):
-                # JSON messages (configuration, events)
-                logger.debug(f"Client → Azure [session {session_id[:8]}]: {message[:100]}...")
-                await azure_ws.send(message)
-                sessions[session_id]['message_count'] += 1
-            elif isinstance(message, bytes):
-                # Binary audio data
-                logger.debug(f"Client → Azure [session {session_id[:8]}]: {len(message)} bytes audio")
+        while True:
+            done, _ = await asyncio.wait(
+                {client_recv, azure_recv},
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            
+            if client_recv in done:
+                message = client_recv.result()
+                if type(message) is bytes:
+                    # Binary audio data
+                    if DEBUG_ENABLED:
+                        logger.debug("Client → Azure [session %s]: %d bytes audio", short_id, len(message))
+                else:
+                    # JSON messages (configuration, events)
+                    if DEBUG_ENABLED:
+                        logger.debug("Client → Azure [session %s]: %.100s...", short_id, message)
+                    message_count += 1
+                    if not message_count & (MESSAGE_COUNT_FLUSH - 1):
+                        session['message_count'] = message_count
                 await azure_ws.send(message)
-    except websockets.exceptions.ConnectionClosed:
-        logger.info(f"Client disconnected [session {session_id[:8]}]")
-    except Exception as e:
-        logger.error(f"Error proxying client to Azure: {e}")
-
-
-async def proxy_azure_to_client(azure_ws, client_ws, session_id: str):
-    """Forward messages from Azure back to client browser"""
-    try:
-        async for message in azure_ws:
-            if isinstance(message, str):
-                # JSON messages (transcripts, events)
-                logger.debug(f"Azure → Client [session {session_id[:8]}]: {message[:100]}...")
-                await client_ws.send(message)
-            elif isinstance(message, bytes):
-                # Binary audio data
-                logger.debug(f"Azure → Client [session {session_id[:8]}]: {len(message)} bytes audio")
+                client_recv = asyncio.create_task(client_ws.recv())
+            
+            if azure_recv in done:
+                message = azure_recv.result()
+                if DEBUG_ENABLED:
+                    if type(message) is bytes:
+                        # Binary audio data
+                        logger.debug("Azure → Client [session %s]: %d bytes audio", short_id, len(message))
+                    else:
+                        # JSON messages (transcripts, events)
+                        logger.debug("Azure → Client [session %s]: %.100s...", short_id, message)
                 await client_ws.send(message)
+                azure_recv = asyncio.create_task(azure_ws.recv())
     except websockets.exceptions.ConnectionClosed:
-        logger.info(f"Azure disconnected [session {session_id[:8]}]")
+        side = 'Client' if client_ws.state is not State.OPEN else 'Azure'
+        logger.info(f"{side} disconnected [session {short_id}]")
     except Exception as e:
-        logger.error(f"Error proxying Azure to client: {e}")
+        logger.error(f"Error proxying session {short_id}: {e}")
+    finally:
+        session['message_count'] = message_count
+        # Cancel the surviving recv() and wait for it, so no read is still
+        # in flight when the connections close. Canceling is safe: no
+        # message is lost.
+        pending = [task for task in (client_recv, azure_recv) if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        for task in (client_recv, azure_recv):
+            if not task.cancelled():
+                task.exception()  # Mark any failure as retrieved
 
 
 async def handle_client_connection(websocket):
@@ -209,30 +323,20 @@ async def handle_client_connection(websocket):
         
         # Create session
         session_id = create_session(user_id)
+        short_id = session_id[:8]
         sessions[session_id]['client_ws'] = websocket
         
-        logger.info(f"✓ Client connected: user={user_id}, session={session_id[:8]}")
+        logger.info(f"✓ Client connected: user={user_id}, session={short_id}")
         
         # Connect to Azure OpenAI
-        azure_url = build_azure_websocket_url()
-        logger.info(f"Connecting to Azure for session {session_id[:8]}...")
+        logger.info(f"Connecting to Azure for session {short_id}...")
         
-        async with websockets.connect(
-            azure_url,
-            max_size=10 * 1024 * 1024,  # 10MB max message size
-            ping_interval=20,
-            ping_timeout=20,
-            user_agent_header='Realtime-Voice-Bot/1.0'
-        ) as azure_ws:
+        async with websockets.connect(AZURE_WS_URL, **AZURE_CONNECT_OPTIONS) as azure_ws:
             sessions[session_id]['azure_ws'] = azure_ws
-            logger.info(f"✓ Connected to Azure for session {session_id[:8]}")
+            logger.info(f"✓ Connected to Azure for session {short_id}")
             
             # Start bidirectional proxying
-            await asyncio.gather(
-                proxy_client_to_azure(websocket, azure_ws, session_id),
-                proxy_azure_to_client(azure_ws, websocket, session_id),
-                return_exceptions=True
-            )
+            await proxy_session(websocket, azure_ws, session_id)
     
     except websockets.exceptions.WebSocketException as e:
         # Catch all websocket exceptions (replaces deprecated InvalidStatusCode)
@@ -258,27 +362,32 @@ async def handle_client_connection(websocket):
         if session_id:
             session = sessions.get(session_id)
             if session:
-                logger.info(f"Session {session_id[:8]} stats: {session['message_count']} messages")
+                logger.info(f"Session {short_id} stats: {session['message_count']} messages")
             cleanup_session(session_id)
         
-        try:
-            await websocket.close()
-        except:
-            pass
+        # Usually the client already closed; skip the redundant close handshake
+        if websocket.state is State.OPEN:
+            try:
+                await websocket.close()
+            except:
+                pass
 
 
 async def periodic_cleanup():
-    """Periodically clean up stale sessions"""
+    """
+    Fallback sweep for state that isn't evicted on access.
+    Stale sessions are mostly expired by create_session; this catches
+    quiet periods.
+    """
     while True:
-        await asyncio.sleep(300)  # Every 5 minutes
-        now = datetime.now()
-        stale_sessions = [
-            sid for sid, session in sessions.items()
-            if (now - session['created_at']).total_seconds() > 3600  # 1 hour
-        ]
-        for sid in stale_sessions:
-            logger.warning(f"Cleaning up stale session {sid[:8]}")
-            cleanup_session(sid)
+        await asyncio.sleep(CLEANUP_INTERVAL)
+        now = time.monotonic()
+        expire_sessions(now)
+        
+        # Forget users whose last session ended inside the rate limit window
+        idle_users = [uid for uid, state in user_state.items() if state.is_idle(now)]
+        for uid in idle_users:
+            del user_state[uid]
 
 
 async def main():
@@ -292,6 +401,7 @@ async def main():
     logger.info(f"Azure: {AZURE_ENDPOINT}")
     logger.info(f"Deployment: {AZURE_DEPLOYMENT}")
     logger.info(f"Rate Limit: {MAX_REQUESTS_PER_MINUTE} req/min, {MAX_CONNECTIONS_PER_USER} concurrent")
+    logger.info(f"Event loop: {'uvloop' if uvloop is not None else 'asyncio'}")
     logger.info("=" * 60)
     
     # Start cleanup task
@@ -312,7 +422,10 @@ async def main():
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("\n👋 Server shutting down...")
     except Exception as e:
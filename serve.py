@@ -3,44 +3,60 @@
 Simple HTTP server for serving the voice bot frontend
 """
 
-import http.server
-import socketserver
+import asyncio
 import webbrowser
-import os
 from pathlib import Path
+from aiohttp import web
+
+PORT = 8000
+
+
+@web.middleware
+async def add_headers(request, handler):
+    response = await handler(request)
+    # Add CORS headers
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+    response.headers['Access-Control-Allow-Headers'] = '*'
+    # Required for audio worklets
+    response.headers['Cross-Origin-Embedder-Policy'] = 'require-corp'
+    response.headers['Cross-Origin-Opener-Policy'] = 'same-origin'
+    return response
+
+
+async def serve(frontend_dir: Path):
+    # FileResponse streams files with sendfile() where the transport allows it
+    async def index(request):
+        return web.FileResponse(frontend_dir / 'index.html')
+
+    app = web.Application(middlewares=[add_headers])
+    app.router.add_get('/', index)
+    app.router.add_static('/', frontend_dir)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, port=PORT).start()
+        print(f"🌐 Voice Bot Frontend Server")
+        print(f"📡 Server running at http://localhost:{PORT}")
+        print(f"📁 Serving files from: {frontend_dir}")
+        print(f"🔗 Opening browser...")
+        print(f"📝 Press Ctrl+C to stop\n")
+
+        # Open browser
+        webbrowser.open(f'http://localhost:{PORT}')
+
+        print("🎤 Ready!")
+        await asyncio.Event().wait()  # Run forever
+    finally:
+        await runner.cleanup()
+
 
 def main():
-    # Change to frontend directory
-    frontend_dir = Path(__file__).parent / 'frontend'
-    os.chdir(frontend_dir)
-    
-    PORT = 8000
-    
-    class CustomHandler(http.server.SimpleHTTPRequestHandler):
-        def end_headers(self):
-            # Add CORS headers
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-            self.send_header('Access-Control-Allow-Headers', '*')
-            # Required for audio worklets
-            self.send_header('Cross-Origin-Embedder-Policy', 'require-corp')
-            self.send_header('Cross-Origin-Opener-Policy', 'same-origin')
-            super().end_headers()
-    
+    frontend_dir = Path(__file__).resolve().parent / 'frontend'
+
     try:
-        with socketserver.TCPServer(("", PORT), CustomHandler) as httpd:
-            print(f"🌐 Voice Bot Frontend Server")
-            print(f"📡 Server running at http://localhost:{PORT}")
-            print(f"📁 Serving files from: {frontend_dir}")
-            print(f"🔗 Opening browser...")
-            print(f"📝 Press Ctrl+C to stop\n")
-            
-            # Open browser
-            webbrowser.open(f'http://localhost:{PORT}')
-            
-            print("🎤 Ready!")
-            httpd.serve_forever()
-            
+        asyncio.run(serve(frontend_dir))
     except KeyboardInterrupt:
         print("\n👋 Server stopped.")
     except OSError as e: